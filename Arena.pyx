@@ -66,10 +66,10 @@ class Arena():
             self.display(board)
         return self.game.getGameEnded(board, 1)
 
-    def playGames(self, num, verbose=False):
+    def playGames(self, num, verbose=False, progress=True):
         """
         Plays num games in which player1 starts num/2 games and player2 starts
-        num/2 games.
+        num/2 games. progress=False hides the progress bar.
 
         Returns:
             oneWon: games won by player1
@@ -77,7 +77,8 @@ class Arena():
             draws:  games won by nobody
         """
         eps_time = AverageMeter()
-        bar = Bar('Arena.playGames', max=num)
+        if progress:
+            bar = Bar('Arena.playGames', max=num)
         end = time.time()
         eps = 0
         maxeps = int(num)
@@ -98,10 +99,11 @@ class Arena():
             eps += 1
             eps_time.update(time.time() - end)
             end = time.time()
-            bar.suffix = '({eps}/{maxeps}) Winrate: {wr}%% | Eps Time: {et:.3f}s | Total: {total:} | ETA: {eta:}'.format(
-                eps=eps, maxeps=maxeps, et=eps_time.avg, total=bar.elapsed_td, eta=bar.eta_td,
-                wr=int(100*(oneWon+0.5*draws)/(oneWon+twoWon+draws)))
-            bar.next()
+            if progress:
+                bar.suffix = '({eps}/{maxeps}) Winrate: {wr}%% | Eps Time: {et:.3f}s | Total: {total:} | ETA: {eta:}'.format(
+                    eps=eps, maxeps=maxeps, et=eps_time.avg, total=bar.elapsed_td, eta=bar.eta_td,
+                    wr=int(100*(oneWon+0.5*draws)/(oneWon+twoWon+draws)))
+                bar.next()
 
         self.player1, self.player2 = self.player2, self.player1
 
@@ -117,12 +119,14 @@ class Arena():
             eps += 1
             eps_time.update(time.time() - end)
             end = time.time()
-            bar.suffix = '({eps}/{maxeps}) Winrate: {wr}%% | Eps Time: {et:.3f}s | Total: {total:} | ETA: {eta:}'.format(
-                eps=eps, maxeps=maxeps, et=eps_time.avg, total=bar.elapsed_td, eta=bar.eta_td,
-                wr=int(100*(oneWon+0.5*draws)/(oneWon+twoWon+draws)))
-            bar.next()
-
-        bar.update()
-        bar.finish()
+            if progress:
+                bar.suffix = '({eps}/{maxeps}) Winrate: {wr}%% | Eps Time: {et:.3f}s | Total: {total:} | ETA: {eta:}'.format(
+                    eps=eps, maxeps=maxeps, et=eps_time.avg, total=bar.elapsed_td, eta=bar.eta_td,
+                    wr=int(100*(oneWon+0.5*draws)/(oneWon+twoWon+draws)))
+                bar.next()
+
+        if progress:
+            bar.update()
+            bar.finish()
 
         return oneWon, twoWon, draws
@@ -9,11 +9,14 @@ from tensorboardX import SummaryWriter
 from Arena import Arena
 from GenericPlayers import RandomPlayer, NNPlayer
 from pytorch_classification.utils import Bar, AverageMeter
+from utils import SharedRing
 from queue import Empty
 from time import time
 import numpy as np
 from math import ceil
 import os
+import pickle
+import warnings
 
 
 class Coach:
@@ -21,7 +24,6 @@ class Coach:
         np.random.seed()
         self.game = game
         self.nnet = nnet
-        self.pnet = self.nnet.__class__(self.game)
         self.args = args
 
         networks = sorted(glob(self.args.checkpoint+'/*'))
@@ -39,26 +41,69 @@ class Coach:
         self.policy_tensors = []
         self.value_tensors = []
         self.batch_ready = []
-        self.ready_queue = mp.Queue()
-        self.file_queue = mp.Queue()
-        self.result_queue = mp.Queue()
+        self.start_iteration = []
+        self.stop_agents = mp.Event()
+        self.ready_queue = SharedRing(self.args.workers)
+        # p1 wins, p2 wins and draws of the current iteration
+        self.game_results = mp.Array('i', 3)
         self.completed = mp.Value('i', 0)
         self.games_played = mp.Value('i', 0)
+        self.expert_weight = mp.Value('d', 0)
+
+        self.copy_stream = torch.cuda.Stream() if torch.cuda.is_available() else None
+
+        # shared memory can not be pinned, so inference goes through two sets of
+        # pinned buffers that alternate between consecutive batches
+        boardx, boardy = self.game.getBoardSize()
+        staging_size = self.args.workers * self.args.process_batch_size
+        self.pinned_inputs = []
+        self.pinned_policies = []
+        self.pinned_values = []
+        if self.copy_stream is not None:
+            for _ in range(2):
+                self.pinned_inputs.append(torch.zeros(
+                    [staging_size, boardx, boardy]).pin_memory())
+                self.pinned_policies.append(torch.zeros(
+                    [staging_size, self.game.getActionSize()]).pin_memory())
+                self.pinned_values.append(torch.zeros(
+                    [staging_size, 1]).pin_memory())
+
+        # every agent reserves rows of these buffers for the samples it generates
+        max_samples = self.args.maxSamplesPerIteration
+        if not max_samples:
+            # worst case: every move is a sample and a game has at most one move per square
+            symmetries = 1
+            if self.args.symmetricSamples:
+                action_size = self.game.getActionSize()
+                symmetries = len(self.game.getSymmetries(
+                    self.game.getInitBoard(), np.full(action_size, 1 / action_size)))
+            max_samples = self.args.gamesPerIteration * boardx * boardy * symmetries
+        self.sample_data = torch.zeros(
+            [max_samples, boardx, boardy]).share_memory_()
+        self.sample_policy = torch.zeros(
+            [max_samples, self.game.getActionSize()]).share_memory_()
+        self.sample_value = torch.zeros(
+            [max_samples, 1]).share_memory_()
+        self.sample_count = mp.Value('i', 0)
+        self.arena_pool = None
+
+        # scalars are flushed together at the end of every iteration
         if self.args.run_name != '':
-            self.writer = SummaryWriter(log_dir='runs/'+self.args.run_name)
+            self.writer = SummaryWriter(
+                log_dir='runs/'+self.args.run_name, max_queue=100, flush_secs=600)
         else:
-            self.writer = SummaryWriter()
+            self.writer = SummaryWriter(max_queue=100, flush_secs=600)
         self.args.expertValueWeight.current = self.args.expertValueWeight.start
 
     def learn(self):
         print('Because of batching, it can take a long time before any games finish.')
+        self.generateSelfPlayAgents()
         for i in range(self.args.startIter, self.args.numIters + 1):
             print(f'------ITER {i}------')
-            self.generateSelfPlayAgents()
+            self.startSelfPlayIteration()
             self.processSelfPlayBatches()
             self.saveIterationSamples(i)
             self.processGameResults(i)
-            self.killSelfPlayAgents()
             self.train(i)
             if self.args.compareWithRandom and (i-1) % self.args.randomCompareFreq == 0:
                 if i == 1:
@@ -67,52 +112,86 @@ class Coach:
                 self.compareToRandom(i)
             if self.args.compareWithPast and (i - 1) % self.args.pastCompareFreq == 0:
                 self.compareToPast(i)
+            self.closeArenaPool()
             z = self.args.expertValueWeight
             self.args.expertValueWeight.current = min(
                 i, z.iterations)/z.iterations * (z.end - z.start) + z.start
+            self.writer.flush()
             print()
+        self.killSelfPlayAgents()
         self.writer.close()
 
     def generateSelfPlayAgents(self):
-        self.ready_queue = mp.Queue()
         boardx, boardy = self.game.getBoardSize()
         for i in range(self.args.workers):
             self.input_tensors.append(torch.zeros(
                 [self.args.process_batch_size, boardx, boardy]))
-            self.input_tensors[i].pin_memory()
             self.input_tensors[i].share_memory_()
 
             self.policy_tensors.append(torch.zeros(
                 [self.args.process_batch_size, self.game.getActionSize()]))
-            self.policy_tensors[i].pin_memory()
             self.policy_tensors[i].share_memory_()
 
             self.value_tensors.append(torch.zeros(
                 [self.args.process_batch_size, 1]))
-            self.value_tensors[i].pin_memory()
             self.value_tensors[i].share_memory_()
             self.batch_ready.append(mp.Event())
+            self.start_iteration.append(mp.Event())
 
             self.agents.append(
-                SelfPlayAgent(i, self.game, self.ready_queue, self.batch_ready[i],
-                              self.input_tensors[i], self.policy_tensors[i], self.value_tensors[i], self.file_queue,
-                              self.result_queue, self.completed, self.games_played, self.args))
+                SelfPlayAgent(i, self.game, self.ready_queue, self.batch_ready[i], self.start_iteration[i],
+                              self.stop_agents, self.input_tensors[i], self.policy_tensors[i], self.value_tensors[i],
+                              self.sample_data, self.sample_policy, self.sample_value, self.sample_count,
+                              self.game_results, self.completed, self.games_played, self.expert_weight, self.args))
             self.agents[i].start()
 
+    def startSelfPlayIteration(self):
+        # the agents stay alive between iterations and wait to be restarted
+        self.completed.value = 0
+        self.games_played.value = 0
+        self.sample_count.value = 0
+        for i in range(len(self.game_results)):
+            self.game_results[i] = 0
+        self.expert_weight.value = self.args.expertValueWeight.current
+        for start in self.start_iteration:
+            start.set()
+
     def processSelfPlayBatches(self):
         sample_time = AverageMeter()
         bar = Bar('Generating Samples', max=self.args.gamesPerIteration)
         end = time()
 
         n = 0
+        pending = None
+        slot = 0
         while self.completed.value != self.args.workers:
             try:
-                id = self.ready_queue.get(timeout=1)
-                self.policy, self.value = self.nnet.process(
-                    self.input_tensors[id])
-                self.policy_tensors[id].copy_(self.policy)
-                self.value_tensors[id].copy_(self.value)
-                self.batch_ready[id].set()
+                try:
+                    ids = [self.ready_queue.get_nowait()]
+                except Empty:
+                    # nothing to overlap with, hand back the previous batch before waiting
+                    self.releaseBatch(pending)
+                    pending = None
+                    ids = [self.ready_queue.get(timeout=1)]
+                while True:
+                    try:
+                        ids.append(self.ready_queue.get_nowait())
+                    except Empty:
+                        break
+                inputs = [self.input_tensors[id] for id in ids]
+                if self.copy_stream is None:
+                    batch = torch.cat(inputs)
+                else:
+                    # stage through pinned memory so the transfer to the gpu is asynchronous
+                    size = len(ids) * self.args.process_batch_size
+                    batch = torch.cat(
+                        inputs, out=self.pinned_inputs[slot][:size])
+                policy, value = self.nnet.process(batch)
+                self.releaseBatch(pending)
+                pending = self.copyBatch(ids, policy, value, slot)
+                # the copy stream keeps them alive, let the next forward pass reuse their memory
+                del policy, value
+                slot = 1 - slot
             except Empty:
                 pass
             size = self.games_played.value
@@ -126,60 +205,81 @@ class Coach:
         bar.finish()
         print()
 
+    def copyBatch(self, ids, policy, value, slot):
+        if not policy.is_cuda:
+            # the forward pass already finished, hand the results back right away
+            self.copyResults(ids, policy, value)
+            for id in ids:
+                self.batch_ready[id].set()
+            return None
+
+        # copy back on a side stream so the next forward pass can be launched right away
+        size = len(ids) * self.args.process_batch_size
+        self.copy_stream.wait_stream(torch.cuda.current_stream())
+        with torch.cuda.stream(self.copy_stream):
+            self.pinned_policies[slot][:size].copy_(policy, non_blocking=True)
+            self.pinned_values[slot][:size].copy_(value, non_blocking=True)
+        policy.record_stream(self.copy_stream)
+        value.record_stream(self.copy_stream)
+        return ids, self.copy_stream.record_event(), slot
+
+    def releaseBatch(self, pending):
+        if pending is None:
+            return
+        ids, event, slot = pending
+        event.synchronize()
+        self.copyResults(
+            ids, self.pinned_policies[slot], self.pinned_values[slot])
+        for id in ids:
+            self.batch_ready[id].set()
+
+    def copyResults(self, ids, policy, value):
+        batch_size = self.args.process_batch_size
+        for k, id in enumerate(ids):
+            self.policy_tensors[id].copy_(
+                policy[k*batch_size:(k+1)*batch_size])
+            self.value_tensors[id].copy_(
+                value[k*batch_size:(k+1)*batch_size])
+
     def killSelfPlayAgents(self):
-        for i in range(self.args.workers):
-            self.agents[i].join()
-            del self.input_tensors[0]
-            del self.policy_tensors[0]
-            del self.value_tensors[0]
-            del self.batch_ready[0]
+        self.stop_agents.set()
+        for start in self.start_iteration:
+            start.set()
+        for agent in self.agents:
+            agent.join()
         self.agents = []
         self.input_tensors = []
         self.policy_tensors = []
         self.value_tensors = []
         self.batch_ready = []
-        self.ready_queue = mp.Queue()
-        self.completed = mp.Value('i', 0)
-        self.games_played = mp.Value('i', 0)
+        self.start_iteration = []
 
     def saveIterationSamples(self, iteration):
-        num_samples = self.file_queue.qsize()
+        num_samples = min(self.sample_count.value, self.sample_data.shape[0])
         print(f'Saving {num_samples} samples')
-        boardx, boardy = self.game.getBoardSize()
-        data_tensor = torch.zeros([num_samples, boardx, boardy])
-        policy_tensor = torch.zeros([num_samples, self.game.getActionSize()])
-        value_tensor = torch.zeros([num_samples, 1])
-        for i in range(num_samples):
-            data, policy, value = self.file_queue.get()
-            data_tensor[i] = torch.from_numpy(data)
-            policy_tensor[i] = torch.tensor(policy)
-            value_tensor[i, 0] = value
+        dropped = self.sample_count.value - num_samples
+        if dropped > 0:
+            warnings.warn(f'Dropped {dropped} of {self.sample_count.value} samples in iteration {iteration}, '
+                          f'increase maxSamplesPerIteration')
+        # clone the filled rows, saving a slice would write the whole shared storage
+        data_tensor = self.sample_data[:num_samples].clone()
+        policy_tensor = self.sample_policy[:num_samples].clone()
+        value_tensor = self.sample_value[:num_samples].clone()
 
         os.makedirs(self.args.data, exist_ok=True)
 
-        torch.save(
-            data_tensor, f'{self.args.data}/iteration-{iteration:04d}-data.pkl')
-        torch.save(policy_tensor,
-                   f'{self.args.data}/iteration-{iteration:04d}-policy.pkl')
-        torch.save(
-            value_tensor, f'{self.args.data}/iteration-{iteration:04d}-value.pkl')
+        torch.save({
+            'data': data_tensor,
+            'policy': policy_tensor,
+            'value': value_tensor
+        }, f'{self.args.data}/iteration-{iteration:04d}.pkl', pickle_protocol=pickle.HIGHEST_PROTOCOL)
         del data_tensor
         del policy_tensor
         del value_tensor
 
     def processGameResults(self, iteration):
-        num_games = self.result_queue.qsize()
-        p1wins = 0
-        p2wins = 0
-        draws = 0
-        for _ in range(num_games):
-            winner = self.result_queue.get()
-            if winner == 1:
-                p1wins += 1
-            elif winner == -1:
-                p2wins += 1
-            else:
-                draws += 1
+        p1wins, p2wins, draws = self.game_results[:]
+        num_games = p1wins + p2wins + draws
         self.writer.add_scalar('win_rate/p1 vs p2',
                                (p1wins+0.5*draws)/num_games, iteration)
         self.writer.add_scalar('win_rate/draws', draws/num_games, iteration)
@@ -191,14 +291,15 @@ class Coach:
             max(4, (iteration + 4)//2),
             self.args.numItersForTrainExamplesHistory)
         for i in range(max(1, iteration - currentHistorySize), iteration + 1):
-            data_tensor = torch.load(
-                f'{self.args.data}/iteration-{i:04d}-data.pkl')
-            policy_tensor = torch.load(
-                f'{self.args.data}/iteration-{i:04d}-policy.pkl')
-            value_tensor = torch.load(
-                f'{self.args.data}/iteration-{i:04d}-value.pkl')
+            filename = f'{self.args.data}/iteration-{i:04d}.pkl'
+            if os.path.exists(filename):
+                samples = torch.load(filename, map_location='cpu')
+            else:
+                # runs started before samples were saved in a single file
+                samples = {key: torch.load(f'{self.args.data}/iteration-{i:04d}-{key}.pkl', map_location='cpu')
+                           for key in ('data', 'policy', 'value')}
             datasets.append(TensorDataset(
-                data_tensor, policy_tensor, value_tensor))
+                samples['data'], samples['policy'], samples['value']))
 
         dataset = ConcatDataset(datasets)
         dataloader = DataLoader(dataset, batch_size=self.args.train_batch_size, shuffle=True,
@@ -219,47 +320,114 @@ class Coach:
 
     def compareToPast(self, iteration):
         past = max(0, iteration-self.args.pastCompareFreq)
-        self.pnet.load_checkpoint(folder=self.args.checkpoint,
-                                  filename=f'iteration-{past:04d}.pkl')
         print(f'PITTING AGAINST ITERATION {past}')
-        if(self.args.arenaMCTS):
-            pplayer = MCTS(self.game, self.pnet, self.args)
-            nplayer = MCTS(self.game, self.nnet, self.args)
-
-            def playpplayer(x, turn):
-                if turn <= 2:
-                    pplayer.reset()
-                temp = self.args.temp if turn <= self.args.tempThreshold else self.args.arenaTemp
-                policy = pplayer.getActionProb(x, temp=temp)
-                return np.random.choice(len(policy), p=policy)
-
-            def playnplayer(x, turn):
-                if turn <= 2:
-                    nplayer.reset()
-                temp = self.args.temp if turn <= self.args.tempThreshold else self.args.arenaTemp
-                policy = nplayer.getActionProb(x, temp=temp)
-                return np.random.choice(len(policy), p=policy)
-
-            arena = Arena(playnplayer, playpplayer, self.game)
-        else:
-            pplayer = NNPlayer(self.game, self.pnet, self.args.arenaTemp)
-            nplayer = NNPlayer(self.game, self.nnet, self.args.arenaTemp)
-
-            arena = Arena(nplayer.play, pplayer.play, self.game)
-        nwins, pwins, draws = arena.playGames(self.args.arenaCompare)
+        nwins, pwins, draws = self.playArenaGames(
+            iteration, past, self.args.arenaCompare)
 
         print(f'NEW/PAST WINS : {nwins} / {pwins} ; DRAWS : {draws}\n')
         self.writer.add_scalar(
             'win_rate/past', float(nwins + 0.5 * draws) / (pwins + nwins + draws), iteration)
 
     def compareToRandom(self, iteration):
-        r = RandomPlayer(self.game)
-        nnplayer = NNPlayer(self.game, self.nnet, self.args.arenaTemp)
         print('PITTING AGAINST RANDOM')
-
-        arena = Arena(nnplayer.play, r.play, self.game)
-        nwins, pwins, draws = arena.playGames(self.args.arenaCompareRandom)
+        nwins, pwins, draws = self.playArenaGames(
+            iteration, None, self.args.arenaCompareRandom)
 
         print(f'NEW/RANDOM WINS : {nwins} / {pwins} ; DRAWS : {draws}\n')
         self.writer.add_scalar(
             'win_rate/random', float(nwins + 0.5 * draws) / (pwins + nwins + draws), iteration)
+
+    def playArenaGames(self, iteration, past, num):
+        if self.arena_pool is None:
+            # cuda can not be used in forked processes
+            self.arena_pool = mp.get_context('spawn').Pool(self.args.arenaWorkers)
+        # each shard plays both sides equally, so split the games in pairs,
+        # several shards per process keep the progress bar moving
+        pairs = int(num/2)
+        count = max(1, min(4 * self.args.arenaWorkers, pairs))
+        shards = [2 * (pairs // count + (k < pairs % count))
+                  for k in range(count)]
+        tasks = [(self.game, self.nnet.__class__, self.args, iteration, past, shard)
+                 for shard in shards]
+
+        bar = Bar('Arena.playGames', max=2*pairs)
+        nwins, pwins, draws = 0, 0, 0
+        for shard_nwins, shard_pwins, shard_draws in self.arena_pool.imap_unordered(playArenaShard, tasks):
+            nwins += shard_nwins
+            pwins += shard_pwins
+            draws += shard_draws
+            played = nwins + pwins + draws
+            bar.suffix = f'({played}/{2*pairs}) Winrate: {int(100*(nwins+0.5*draws)/played)}% | Total: {bar.elapsed_td} | ETA: {bar.eta_td:}'
+            bar.goto(played)
+        bar.finish()
+        return nwins, pwins, draws
+
+    def closeArenaPool(self):
+        # the arena processes hold their own cuda contexts and networks,
+        # so they only live for the comparisons of one iteration
+        if self.arena_pool is not None:
+            self.arena_pool.close()
+            self.arena_pool.join()
+            self.arena_pool = None
+
+
+# networks loaded by an arena process, shared by the comparisons of an iteration
+arenaNets = {}
+
+
+def loadArenaNet(game, nnet_class, args, iteration):
+    if iteration not in arenaNets:
+        nnet = nnet_class(game)
+        checkpoint = torch.load(os.path.join(args.checkpoint, f'iteration-{iteration:04d}.pkl'),
+                                map_location='cpu')
+        nnet.nnet.load_state_dict(checkpoint['state_dict'])
+        arenaNets[iteration] = nnet
+    return arenaNets[iteration]
+
+
+def playArenaShard(task):
+    return playArena(*task)
+
+
+def playArena(game, nnet_class, args, iteration, past, num):
+    """
+    Plays num arena games between the checkpoint of iteration and the
+    checkpoint of past, or a random player if past is None. The networks are
+    loaded from disk so that this can run in a spawned process.
+    """
+    for loaded in list(arenaNets):
+        if loaded != iteration and loaded != past:
+            del arenaNets[loaded]
+    nnet = loadArenaNet(game, nnet_class, args, iteration)
+    if past is None:
+        r = RandomPlayer(game)
+        nnplayer = NNPlayer(game, nnet, args.arenaTemp)
+        arena = Arena(nnplayer.play, r.play, game)
+        return arena.playGames(num, progress=False)
+
+    pnet = loadArenaNet(game, nnet_class, args, past)
+    if(args.arenaMCTS):
+        pplayer = MCTS(game, pnet, args)
+        nplayer = MCTS(game, nnet, args)
+
+        def playpplayer(x, turn):
+            if turn <= 2:
+                pplayer.reset()
+            temp = args.temp if turn <= args.tempThreshold else args.arenaTemp
+            policy = pplayer.getActionProb(x, temp=temp)
+            return np.random.choice(len(policy), p=policy)
+
+        def playnplayer(x, turn):
+            if turn <= 2:
+                nplayer.reset()
+            temp = args.temp if turn <= args.tempThreshold else args.arenaTemp
+            policy = nplayer.getActionProb(x, temp=temp)
+            return np.random.choice(len(policy), p=policy)
+
+        arena = Arena(playnplayer, playpplayer, game)
+    else:
+        pplayer = NNPlayer(game, pnet, args.arenaTemp)
+        nplayer = NNPlayer(game, nnet, args.arenaTemp)
+
+        arena = Arena(nplayer.play, pplayer.play, game)
+    return arena.playGames(num, progress=False)
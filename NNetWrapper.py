@@ -5,6 +5,8 @@ from time import time
 from pytorch_classification.utils import Bar, AverageMeter
 from utils import *
 import os
+import copy
+import pickle
 import numpy as np
 import math
 import sys
@@ -15,6 +17,8 @@ sys.path.append('../../')
 args = dotdict({
     'lr': 0.001,
     'cuda': torch.cuda.is_available(),
+    # run self-play inference on a half precision copy of the network
+    'half': torch.cuda.is_available(),
     'num_channels': 128,
     'depth': 5,
 })
@@ -25,6 +29,7 @@ class NNetWrapper():
         self.nnet = nnetarch(game, args)
         self.board_x, self.board_y = game.getBoardSize()
         self.action_size = game.getActionSize()
+        self.half_nnet = None
         self.optimizer = optim.SGD(
             self.nnet.parameters(), lr=args.lr, momentum=0.9, weight_decay=1e-3)
         # self.scheduler = optim.lr_scheduler.MultiStepLR(
@@ -36,6 +41,7 @@ class NNetWrapper():
             self.nnet.cuda()
 
     def train(self, batches, train_steps):
+        self.half_nnet = None
         self.nnet.train()
 
         data_time = AverageMeter()
@@ -57,7 +63,8 @@ class NNetWrapper():
                 # predict
                 if args.cuda:
                     boards, target_pis, target_vs = boards.contiguous().cuda(
-                    ), target_pis.contiguous().cuda(), target_vs.contiguous().cuda()
+                        non_blocking=True), target_pis.contiguous().cuda(
+                        non_blocking=True), target_vs.contiguous().cuda(non_blocking=True)
 
                 # measure data loading time
                 data_time.update(time() - end)
@@ -120,7 +127,15 @@ class NNetWrapper():
 
     def process(self, batch):
         if args.cuda:
-            batch = batch.cuda()
+            batch = batch.cuda(non_blocking=True)
+        # torch has no half precision convolutions on the cpu
+        if args.cuda and args.half:
+            if self.half_nnet is None:
+                self.half_nnet = copy.deepcopy(self.nnet).half()
+                self.half_nnet.eval()
+            with torch.no_grad():
+                pi, v = self.half_nnet(batch.half())
+                return torch.exp(pi.float()), v.float()
         self.nnet.eval()
         with torch.no_grad():
             pi, v = self.nnet(batch)
@@ -140,7 +155,7 @@ class NNetWrapper():
             'state_dict': self.nnet.state_dict(),
             'opt_state': self.optimizer.state_dict(),
             'sch_state': self.scheduler.state_dict()
-        }, filepath)
+        }, filepath, pickle_protocol=pickle.HIGHEST_PROTOCOL)
 
     def load_checkpoint(self, folder='checkpoint', filename='checkpoint.pth.tar'):
         # https://github.com/pytorch/examples/blob/master/imagenet/main.py#L98
@@ -148,6 +163,7 @@ class NNetWrapper():
         if not os.path.exists(filepath):
             raise ("No model in path {}".format(filepath))
         checkpoint = torch.load(filepath)
+        self.half_nnet = None
         self.nnet.load_state_dict(checkpoint['state_dict'])
         if 'opt_state' in checkpoint:
             self.optimizer.load_state_dict(checkpoint['opt_state'])
@@ -8,19 +8,25 @@ from MCTS import MCTS
 
 class SelfPlayAgent(mp.Process):
 
-    def __init__(self, id, game, ready_queue, batch_ready, batch_tensor, policy_tensor, value_tensor, output_queue,
-             result_queue, complete_count, games_played, args):
-        super().__init__()
+    def __init__(self, id, game, ready_queue, batch_ready, start_iteration, stop, batch_tensor, policy_tensor,
+             value_tensor, sample_data, sample_policy, sample_value, sample_count, game_results, complete_count,
+             games_played, expert_weight, args):
+        super().__init__(daemon=True)
         self.id = id
         self.game = game
         self.ready_queue = ready_queue
         self.batch_ready = batch_ready
+        self.start_iteration = start_iteration
+        self.stop = stop
         self.batch_tensor = batch_tensor
         self.batch_size = self.batch_tensor.shape[0]
         self.policy_tensor = policy_tensor
         self.value_tensor = value_tensor
-        self.output_queue = output_queue
-        self.result_queue = result_queue
+        self.sample_data = sample_data
+        self.sample_policy = sample_policy
+        self.sample_value = sample_value
+        self.sample_count = sample_count
+        self.game_results = game_results
         self.games = []
         self.canonical = []
         self.histories = []
@@ -29,9 +35,35 @@ class SelfPlayAgent(mp.Process):
         self.mcts = []
         self.games_played = games_played
         self.complete_count = complete_count
+        self.expert_weight = expert_weight
         self.args = args
         self.valid = torch.zeros_like(self.policy_tensor)
         self.fast = False
+
+    def run(self):
+        np.random.seed()
+        # numpy views of the shared buffers accept any board layout or policy list
+        self.sample_data_np = self.sample_data.numpy()
+        self.sample_policy_np = self.sample_policy.numpy()
+        self.sample_value_np = self.sample_value.numpy()
+        while True:
+            self.start_iteration.wait()
+            self.start_iteration.clear()
+            if self.stop.is_set():
+                break
+            self.reset()
+            self.playIteration()
+
+    def clear(self):
+        self.games = []
+        self.canonical = []
+        self.histories = []
+        self.player = []
+        self.turn = []
+        self.mcts = []
+
+    def reset(self):
+        self.clear()
         for _ in range(self.batch_size):
             self.games.append(self.game.getInitBoard())
             self.histories.append([])
@@ -40,8 +72,7 @@ class SelfPlayAgent(mp.Process):
             self.mcts.append(MCTS(self.game, None, self.args))
             self.canonical.append(None)
 
-    def run(self):
-        np.random.seed()
+    def playIteration(self):
         while self.games_played.value < self.args.gamesPerIteration:
             self.generateCanonical()
             self.fast = np.random.random_sample() < self.args.probFastSim
@@ -54,10 +85,10 @@ class SelfPlayAgent(mp.Process):
                     self.generateBatch()
                     self.processBatch()
             self.playMoves()
+        # free the search trees while the coach trains and runs the arena
+        self.clear()
         with self.complete_count.get_lock():
             self.complete_count.value += 1
-        self.output_queue.close()
-        self.output_queue.join_thread()
 
     def generateBatch(self):
         for i in range(self.batch_size):
@@ -87,27 +118,36 @@ class SelfPlayAgent(mp.Process):
             self.turn[i] += 1
             winner = self.game.getGameEnded(self.games[i], 1)
             if winner != 0:
-                self.result_queue.put(winner)
+                with self.game_results.get_lock():
+                    if winner == 1:
+                        self.game_results[0] += 1
+                    elif winner == -1:
+                        self.game_results[1] += 1
+                    else:
+                        self.game_results[2] += 1
                 lock = self.games_played.get_lock()
                 lock.acquire()
                 if self.games_played.value < self.args.gamesPerIteration:
                     self.games_played.value += 1
                     lock.release()
+                    boards = []
+                    policies = []
+                    values = []
+                    expert_weight = self.expert_weight.value
                     for hist in self.histories[i]:
+                        value = winner * hist[3] * (1 - expert_weight) \
+                            + expert_weight * hist[2]
                         if self.args.symmetricSamples:
                             sym = self.game.getSymmetries(hist[0], hist[1])
                             for b, p in sym:
-                                self.output_queue.put((b, p,
-                                                       winner *
-                                                       hist[3] *
-                                                       (1 - self.args.expertValueWeight.current)
-                                                       + self.args.expertValueWeight.current * hist[2]))
+                                boards.append(b)
+                                policies.append(p)
+                                values.append(value)
                         else:
-                            self.output_queue.put((hist[0], hist[1],
-                                                   winner *
-                                                   hist[3] *
-                                                   (1 - self.args.expertValueWeight.current)
-                                                   + self.args.expertValueWeight.current * hist[2]))
+                            boards.append(hist[0])
+                            policies.append(hist[1])
+                            values.append(value)
+                    self.addSamples(boards, policies, values)
                     self.games[i] = self.game.getInitBoard()
                     self.histories[i] = []
                     self.player[i] = 1
@@ -116,6 +156,19 @@ class SelfPlayAgent(mp.Process):
                 else:
                     lock.release()
 
+    def addSamples(self, boards, policies, values):
+        # reserve rows under the lock and write them outside of it, the count
+        # still goes past the end so the coach can report dropped samples
+        with self.sample_count.get_lock():
+            i = self.sample_count.value
+            self.sample_count.value = i + len(boards)
+        n = min(len(boards), self.sample_data_np.shape[0] - i)
+        if n > 0:
+            self.sample_data_np[i:i+n] = np.stack(boards[:n])
+            self.sample_policy_np[i:i+n] = np.asarray(
+                policies[:n], dtype=np.float32)
+            self.sample_value_np[i:i+n, 0] = values[:n]
+
     def generateCanonical(self):
         for i in range(self.batch_size):
             self.canonical[i] = self.game.getCanonicalForm(
@@ -17,6 +17,11 @@ args = dotdict({
     'train_steps_per_iteration': 500,
     # should preferably be a multiple of process_batch_size and workers
     'gamesPerIteration': 4*128*(mp.cpu_count()-1),
+    # rows of the shared buffer all workers write self-play samples to. None sizes it for
+    # the worst case, gamesPerIteration * board squares * symmetries (if symmetricSamples).
+    # Set it explicitly for games that can be longer than the board has squares, or to
+    # fit a small /dev/shm. Samples that do not fit are dropped with a warning.
+    'maxSamplesPerIteration': None,
     'numItersForTrainExamplesHistory': 100,
     'symmetricSamples': False,
     'numMCTSSims': 50,
@@ -29,6 +34,8 @@ args = dotdict({
     'arenaCompare': 500,
     'arenaTemp': 0.1,
     'arenaMCTS': False,
+    # every arena process creates its own cuda context
+    'arenaWorkers': 4,
     'randomCompareFreq': 1,
     'compareWithPast': True,
     'pastCompareFreq': 3,
@@ -0,0 +1,67 @@
+"""
+To run tests:
+pytest-3 test_utils.py
+"""
+from queue import Empty
+
+import pytest
+from torch import multiprocessing as mp
+
+from utils import SharedRing
+
+
+def produce(ring, id, count):
+    for i in range(count):
+        ring.put(id * 100 + i)
+
+
+def test_fifo_order():
+    ring = SharedRing(4)
+    for value in [3, 1, 2]:
+        ring.put(value)
+    assert [ring.get(timeout=1) for _ in range(3)] == [3, 1, 2]
+
+
+def test_wrap_around():
+    ring = SharedRing(3)
+    got = []
+    for value in range(10):
+        ring.put(value)
+        if value % 2 == 1:
+            got.append(ring.get(timeout=1))
+            got.append(ring.get(timeout=1))
+    assert got == list(range(10))
+
+
+def test_empty():
+    ring = SharedRing(2)
+    with pytest.raises(Empty):
+        ring.get(timeout=0.01)
+    with pytest.raises(Empty):
+        ring.get_nowait()
+    ring.put(7)
+    assert ring.get_nowait() == 7
+    with pytest.raises(Empty):
+        ring.get_nowait()
+
+
+def test_multiple_producers():
+    # the ring has to hold every value that can be pending at once
+    producers, count = 4, 5
+    ring = SharedRing(producers * count)
+    processes = [mp.Process(target=produce, args=(ring, id, count))
+                 for id in range(producers)]
+    for p in processes:
+        p.start()
+    for p in processes:
+        p.join()
+
+    values = [ring.get(timeout=1) for _ in range(producers * count)]
+    with pytest.raises(Empty):
+        ring.get_nowait()
+    assert sorted(values) == sorted(id * 100 + i for id in range(producers)
+                                    for i in range(count))
+    # each producer's values come out in the order it put them
+    for id in range(producers):
+        own = [v for v in values if v // 100 == id]
+        assert own == sorted(own)
@@ -1,5 +1,48 @@
+from queue import Empty
+
+import torch
+from torch import multiprocessing as mp
+
+__all__ = ['dotdict', 'SharedRing']
+
+
 class dotdict(dict):
     def __getattr__(self, name):
         if name.startswith('__'):
             raise AttributeError
         return self[name]
+
+
+class SharedRing:
+    """
+    Multi-producer, single-consumer ring of ints stored in shared memory.
+
+    Producers write under the tail lock and release a semaphore, so the
+    consumer can block on the semaphore and read the value directly without
+    the pickling and feeder thread of a multiprocessing Queue. get raises
+    queue.Empty like a Queue does. The ring must be at least as large as the
+    number of values that can be pending at once.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.buffer = torch.zeros(size, dtype=torch.int32).share_memory_()
+        self.tail = mp.Value('i', 0)
+        self.head = 0
+        self.sem = mp.Semaphore(0)
+
+    def put(self, value):
+        with self.tail.get_lock():
+            self.buffer[self.tail.value] = value
+            self.tail.value = (self.tail.value + 1) % self.size
+        self.sem.release()
+
+    def get(self, block=True, timeout=None):
+        if not self.sem.acquire(block, timeout):
+            raise Empty
+        value = int(self.buffer[self.head])
+        self.head = (self.head + 1) % self.size
+        return value
+
+    def get_nowait(self):
+        return self.get(False)